@@ -38,12 +38,24 @@ Configuration:
 
 """
 
-import argparse
+from __future__ import annotations
+
+import collections
+import contextlib
 import enum
-import tomllib
-from itertools import count
+import os
+import stat
+import sys
+from collections.abc import Iterator
 from pathlib import Path
 
+# argparse and tomllib are imported where they are used, so importing this
+#  module as a library doesn't pay for the CLI and parsing. typing is avoided
+#  too, type checkers treat this constant as typing.TYPE_CHECKING
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    import argparse
+
 
 class VerboseLevel(enum.IntEnum):
     """Enumeration of verbosity levels for operation feedback.
@@ -63,13 +75,401 @@ class VerboseLevel(enum.IntEnum):
 
 
 MAX_VERBOSE = max(VerboseLevel)
+# plain int copies of the levels, for the checks made on every operation
+_V_RENAME = int(VerboseLevel.RENAME_FILE)
+_V_LINK = int(VerboseLevel.CREATE_LINK)
+_V_OK = int(VerboseLevel.LINK_OK)
+
+
+@contextlib.contextmanager
+def _buffered_output() -> Iterator[list[str]]:
+    """Collect output lines, and write them to stdout at once when done."""
+    lines: list[str] = []
+    try:
+        yield lines
+    finally:
+        if lines:
+            sys.stdout.write("".join(f"{line}\n" for line in lines))
+
+
+def _next_backup_index(p: Path, parent: str | None = None) -> int:
+    """Find an unused N for the backup name `{p}.bkp_{N}`.
+
+    Normally this is one more than the highest existing index, found by listing
+    the parent directory once. If the parent can't be listed (searchable but not
+    readable), fall back to probing indices 0, 1, 2, 4, 8, ... until one is unused,
+    then binary searching below it, which takes O(log N) lstat calls.
+
+    If parent is given, it's searched instead of the directory containing p.
+    """
+    default_parent, name = os.path.split(p)
+    if parent is None:
+        parent = default_parent
+    prefix = f"{name}.bkp_"
+    try:
+        names = os.listdir(parent)
+    except PermissionError:
+        pass
+    else:
+        return 1 + max(
+            (
+                int(suffix)
+                for entry in names
+                if entry.startswith(prefix)
+                and (suffix := entry.removeprefix(prefix)).isascii()
+                and suffix.isdigit()
+            ),
+            default=-1,
+        )
+
+    def is_used(i: int) -> bool:
+        return os.path.lexists(os.path.join(parent, f"{prefix}{i}"))
+
+    if not is_used(0):
+        return 0
+    lo, hi = 0, 1
+    while is_used(hi):
+        lo, hi = hi, hi * 2
+    # lo is used and hi is not, find the lowest unused index between them
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if is_used(mid):
+            lo = mid
+        else:
+            hi = mid
+    return hi
+
+
+class OpKind(enum.Enum):
+    """Kinds of filesystem operations in a plan."""
+
+    RENAME = enum.auto()
+    MKDIR = enum.auto()
+    SYMLINK = enum.auto()
+    EXISTS = enum.auto()
+
+
+class Op(
+    collections.namedtuple(
+        "Op", ["kind", "path", "target", "target_is_dir"], defaults=(None, False)
+    )
+):
+    """A single filesystem operation, created by plan() and run by execute().
+
+    Attributes:
+        kind: The operation to perform
+        path: The file to rename, the directory to create, or the link to create
+            (or that already exists, for EXISTS, which changes nothing)
+        target: The backup name (RENAME), or the path the link points to
+            (SYMLINK, EXISTS)
+        target_is_dir: Whether the link target is a directory, for display only
+
+    """
+
+    __slots__ = ()
+    kind: OpKind
+    path: Path
+    target: Path | None
+    target_is_dir: bool
+
+
+# how many links to follow when resolving a path, as in the kernel's ELOOP limit
+_MAX_LINKS = 40
+
+
+def _planned_state(path: str, planned: dict[str, Op]) -> Op | str | None:
+    """Find what path will be, once the planned operations run.
+
+    planned maps each path that an earlier operation renames away, creates as a
+    backup, as a new directory, or as a link, to the latest such operation. Its
+    keys, like path, have no links in their parents, see _resolve_parents().
+
+    Returns:
+        The planned operation that creates path itself, or the path on disk
+        that path will lead to, or None if path will be inside a directory that
+        was moved away or newly created, and so will not exist.
+
+    """
+    s = path
+    while planned:
+        op = planned.get(s)
+        if op is not None:
+            if op.kind is OpKind.RENAME:
+                assert op.target is not None
+                if s == path and os.path.basename(s) == op.target.name:
+                    # path is the backup that the operation creates
+                    return op
+                # path or one of its parents is moved away, or inside a backup,
+                #  whose content isn't tracked
+                return None
+            if s == path:
+                return op
+            if op.kind is OpKind.MKDIR:
+                # a new directory is empty
+                return None
+            # path is inside a new link, so it leads into the link target
+            assert op.target is not None
+            return os.path.join(op.target, os.path.relpath(path, s))
+        s, prev = os.path.dirname(s), s
+        if s == prev:
+            break
+    return path
+
+
+def _resolve_parents(
+    path: str, planned: dict[str, Op], links: dict[str, str | None]
+) -> str:
+    """Resolve the links in the parents of path, as they will be once the plan runs.
+
+    Like os.path.realpath() on the parent of path, except that it also follows
+    the links that the plan creates, and not the ones it moves away. This gives
+    one name to each path, however it's reached, to key planned with.
+
+    links caches the targets of the links on disk, which don't change while
+    planning.
+    """
+    parent, name = os.path.split(path)
+    pending = parent.split(os.sep)[::-1]
+    # ends with a separator, so a part can be appended to it
+    resolved = os.sep
+    # whether resolved is on disk, or only its planned content will exist
+    on_disk = True
+    followed = 0
+    while pending:
+        part = pending.pop()
+        if not part or part == ".":
+            continue
+        if part == "..":
+            resolved = os.path.join(os.path.dirname(resolved[:-1]) or os.sep, "")
+            on_disk = isinstance(_planned_state(resolved[:-1] or os.sep, planned), str)
+            continue
+        s = resolved + part
+        op = planned.get(s)
+        if op is not None and op.kind is OpKind.SYMLINK:
+            assert op.target is not None
+            target: str | None = os.fspath(op.target)
+        elif op is not None or not on_disk:
+            target = None
+        else:
+            if s not in links:
+                try:
+                    links[s] = os.readlink(s)
+                except OSError:
+                    links[s] = None
+            target = links[s]
+        if target is None or followed >= _MAX_LINKS:
+            resolved = s + os.sep
+            on_disk = on_disk and op is None
+            continue
+        followed += 1
+        if os.path.isabs(target):
+            resolved = os.sep
+        on_disk = isinstance(_planned_state(resolved[:-1] or os.sep, planned), str)
+        pending += target.split(os.sep)[::-1]
+    return resolved + name
+
+
+def _exists_planned(path: str, planned: dict[str, Op]) -> bool:
+    """Check if path will exist once the planned operations run."""
+    state = _planned_state(path, planned)
+    if isinstance(state, str):
+        return os.path.lexists(state)
+    return state is not None
+
+
+def _isdir_planned(path: str, planned: dict[str, Op]) -> bool:
+    """Check if path will be a directory, or a link to one, once the plan runs."""
+    state = _planned_state(path, planned)
+    if isinstance(state, Op):
+        if state.kind is OpKind.MKDIR:
+            return True
+        if state.kind is not OpKind.SYMLINK:
+            return False
+        assert state.target is not None
+        state = os.fspath(state.target)
+    return state is not None and os.path.isdir(state)
+
+
+def _plan_rename(
+    p: Path, key: str, planned: dict[str, Op], ensured_dirs: set[str] | None
+) -> Op:
+    """Plan renaming p to a backup name, and record it in planned under key."""
+    parent = _planned_state(os.path.dirname(key), planned)
+    # a new directory has no backups in it yet
+    index = _next_backup_index(p, parent) if isinstance(parent, str) else 0
+    # skip the backups planned by earlier entries, which aren't on disk yet
+    while f"{key}.bkp_{index}" in planned:
+        index += 1
+    op = Op(OpKind.RENAME, p, Path(f"{p}.bkp_{index}"))
+    # whatever was planned inside p is moved away with it
+    inside = os.path.join(key, "")
+    for planned_path in [k for k in planned if k.startswith(inside)]:
+        del planned[planned_path]
+    planned[key] = op
+    planned[f"{key}.bkp_{index}"] = op
+    if ensured_dirs:
+        # p may have been one of the ensured dirs, or an ancestor of them
+        ensured_dirs.difference_update(
+            [d for d in ensured_dirs if d == key or d.startswith(inside)]
+        )
+    return op
+
+
+def _plan_link(
+    src: Path,
+    dst: Path,
+    planned: dict[str, Op],
+    links: dict[str, str | None],
+    ensured_dirs: set[str] | None,
+) -> list[Op]:
+    """Plan linking dst to src, see safe_link()."""
+    try:
+        src_st = os.stat(src)
+    except OSError as e:
+        # TODO: maybe here i want to mv dst -> src instead?
+        raise ValueError(f"src {src} not found") from e
+    is_dir = stat.S_ISDIR(src_st.st_mode)
+    key = _resolve_parents(str(dst), planned, links)
+    state = _planned_state(key, planned)
+    if isinstance(state, Op):
+        dst_exists = True
+        # an earlier entry links the same path, reached another way
+        is_correct_link = state.kind is OpKind.SYMLINK and state.target == src
+    elif state is None:
+        dst_exists = is_correct_link = False
+    else:
+        try:
+            dst_st = os.lstat(state)
+        except (FileNotFoundError, NotADirectoryError):
+            dst_st = None
+        dst_exists = dst_st is not None
+        if dst_st is not None and stat.S_ISLNK(dst_st.st_mode):
+            target = os.readlink(state)
+            # compare as str first, so an already correct link doesn't build a Path
+            is_correct_link = target == str(src) or Path(target) == src
+        else:
+            is_correct_link = False
+    if is_correct_link:
+        return [Op(OpKind.EXISTS, dst, src, target_is_dir=is_dir)]
+    ops = []
+    if dst_exists:
+        ops.append(_plan_rename(dst, key, planned, ensured_dirs))
+    # interned, so links sharing a parent share the cached strings too
+    parent = sys.intern(os.path.dirname(key))
+    if ensured_dirs is None or parent not in ensured_dirs:
+        mkdir = Op(OpKind.MKDIR, dst.parent)
+        ops.append(mkdir)
+        # record the directories it creates, so later entries see them
+        missing = [parent]
+        while not _exists_planned(missing[-1], planned):
+            missing.append(os.path.dirname(missing[-1]))
+        # unless it's going to fail, since the first existing parent isn't a dir
+        if _isdir_planned(missing[-1], planned):
+            planned.update(dict.fromkeys(missing[:-1], mkdir))
+        if ensured_dirs is not None:
+            while parent not in ensured_dirs:
+                ensured_dirs.add(parent)
+                parent = sys.intern(os.path.dirname(parent))
+    link = Op(OpKind.SYMLINK, dst, src, target_is_dir=is_dir)
+    planned[key] = link
+    ops.append(link)
+    return ops
+
+
+def plan(locations: dict[Path, Path | None]) -> list[Op]:
+    """Plan the operations needed to install the links in the locations dictionary.
+
+    Nothing is changed on disk. Links that are already correct get an EXISTS
+    operation, which only reports them.
+    The operations are ordered so that each backup is made before its path is
+    reused, and each directory is created before links are put in it.
+
+    Args:
+        locations: Dictionary mapping destination paths to source paths
+
+    Returns:
+        The operations to pass to execute()
+
+    """
+    ops: list[Op] = []
+    planned: dict[str, Op] = {}
+    links: dict[str, str | None] = {}
+    ensured_dirs: set[str] = set()
+    for dst, src in locations.items():
+        if not dst.is_absolute():
+            raise ValueError(f"{dst} is not absolute")
+        if src is None:
+            key = _resolve_parents(str(dst), planned, links)
+            if _exists_planned(key, planned):
+                ops.append(_plan_rename(dst, key, planned, ensured_dirs))
+        else:
+            if not src.is_absolute():
+                raise ValueError(f"{src} is not absolute")
+            ops += _plan_link(src, dst, planned, links, ensured_dirs)
+    return ops
+
+
+def _report(op: Op, verbose: int, log: list[str], prefix: str = "") -> None:
+    """Log an operation, if the verbose level asks for it."""
+    is_dir = "/" if op.target_is_dir else ""
+    match op.kind:
+        case OpKind.RENAME if verbose >= _V_RENAME:
+            log.append(f"{prefix}renaming {op.path} -> {op.target}")
+        case OpKind.SYMLINK if verbose >= _V_LINK:
+            log.append(f"{prefix}linking  {op.path} <- {op.target}{is_dir}")
+        case OpKind.EXISTS if verbose >= _V_OK:
+            log.append(f"{prefix}exists   {op.path} <- {op.target}{is_dir}")
+
+
+def _apply(op: Op) -> None:
+    """Perform an operation on disk."""
+    match op:
+        case Op(OpKind.RENAME, path, Path() as backup):
+            # os.rename would silently replace it
+            if os.path.lexists(backup):
+                raise FileExistsError(f"{backup} already exists")
+            os.rename(path, backup)
+        case Op(OpKind.MKDIR, path):
+            os.makedirs(path, exist_ok=True)
+        case Op(OpKind.SYMLINK, path, Path() as target):
+            os.symlink(target, path)
+        case Op(OpKind.EXISTS):
+            pass
+        case _:
+            raise ValueError(f"invalid operation {op}")
+
+
+def execute(
+    ops: list[Op],
+    verbose_level: VerboseLevel = MAX_VERBOSE,
+    *,
+    dry_run: bool = False,
+) -> None:
+    """Run the operations created by plan(), one by one in plan order.
+
+    Args:
+        ops: The operations to run
+        verbose_level: Controls the amount of feedback printed
+        dry_run: Only print the operations, without changing anything. Each
+            line is prefixed with "[dry run] ".
+
+    """
+    verbose = int(verbose_level)
+    prefix = "[dry run] " if dry_run else ""
+    with _buffered_output() as log:
+        for op in ops:
+            _report(op, verbose, log, prefix)
+            if not dry_run:
+                _apply(op)
 
 
 def safe_remove(p: Path, verbose_level: VerboseLevel) -> Path:
     """Safely rename a file or directory to a backup name.
 
-    Creates a backup by appending .bkp_N to the filename, where N is an incrementing
-    number starting from 0, continuing until an unused name is found.
+    Creates a backup by appending .bkp_N to the filename, where N is one more than
+    the highest existing backup index (starting from 0). If the parent directory
+    can't be listed, N is the first unused index instead, so a gap in the
+    numbering is reused: with only .bkp_1 present, N is 0 rather than 2.
 
     Args:
         p: Path to the file or directory to be renamed
@@ -81,21 +481,20 @@ def safe_remove(p: Path, verbose_level: VerboseLevel) -> Path:
     """
     if not p.is_absolute():
         raise ValueError(f"{p} is not absolute")
-    if not p.exists(follow_symlinks=False):
+    if not os.path.lexists(p):
         raise ValueError(f"{p} does not exist")
-    for i in count():
-        p_backup = Path(f"{p}.bkp_{i}")
-        if not p_backup.exists(follow_symlinks=False):
-            break
-    if verbose_level >= VerboseLevel.RENAME_FILE:
-        print(f"renaming {p} -> {p_backup}")
-    p.rename(p_backup)
-    if p.exists(follow_symlinks=False):
-        raise RuntimeError(f"failed to move file: {p}")
+    p_backup = Path(f"{p}.bkp_{_next_backup_index(p)}")
+    execute([Op(OpKind.RENAME, p, p_backup)], verbose_level)
     return p_backup
 
 
-def safe_link(src: Path, dst: Path, verbose_level: VerboseLevel) -> None:
+def safe_link(
+    src: Path,
+    dst: Path,
+    verbose_level: VerboseLevel,
+    *,
+    ensured_dirs: set[str] | None = None,
+) -> None:
     """Create a symbolic link from dst to src, safely handling existing files.
 
     If dst already exists, it will be backed up using safe_remove() before
@@ -106,31 +505,22 @@ def safe_link(src: Path, dst: Path, verbose_level: VerboseLevel) -> None:
         src: Path to the source file/directory to link to
         dst: Path where the symbolic link should be created
         verbose_level: Controls the amount of feedback printed during operation
+        ensured_dirs: Directories already known to exist. The parents of dst are
+            created only if missing from it, and are added to it afterwards.
 
     """
     if not dst.is_absolute():
         raise ValueError(f"{dst} is not absolute")
     if not src.is_absolute():
         raise ValueError(f"{src} is not absolute")
-    is_dir = "/" if src.is_dir() else ""
-    if not src.exists(follow_symlinks=True):
-        # TODO: maybe here i want to mv dst -> src instead?
-        raise ValueError(f"src {src} not found")
-    if dst.is_symlink() and dst.readlink() == src:
-        if verbose_level >= VerboseLevel.LINK_OK:
-            print(f"exists   {dst} <- {src}{is_dir}")
-        return
-    if dst.exists(follow_symlinks=False):
-        safe_remove(dst, verbose_level)
-    if verbose_level >= VerboseLevel.CREATE_LINK:
-        print(f"linking  {dst} <- {src}{is_dir}")
-    dst.parent.mkdir(exist_ok=True, parents=True)
-    dst.symlink_to(src)
+    execute(_plan_link(src, dst, {}, {}, ensured_dirs), verbose_level)
 
 
 def install_links(
     locations: dict[Path, Path | None],
     verbose_level: VerboseLevel = MAX_VERBOSE,
+    *,
+    dry_run: bool = False,
 ) -> None:
     """Install symbolic links according to the locations dictionary.
 
@@ -141,14 +531,20 @@ def install_links(
     Args:
         locations: Dictionary mapping destination paths to source paths
         verbose_level: Controls the amount of feedback printed
+        dry_run: Only print what would be done, prefixed with "[dry run] ",
+            without changing anything
 
     """
-    for dst, src in locations.items():
-        if src is None:
-            if dst.exists(follow_symlinks=False):
-                safe_remove(dst, verbose_level)
-        else:
-            safe_link(src, dst, verbose_level)
+    execute(plan(locations), verbose_level, dry_run=dry_run)
+
+
+def _is_inside(p: Path, root: str) -> bool:
+    """Check that root (ending with a separator) is a strict parent of p.
+
+    Same as `Path(root) in p.parents`, without building the parents sequence.
+    """
+    s = str(p)
+    return len(s) > len(root) and s.startswith(root)
 
 
 def read_locations_file(
@@ -174,6 +570,10 @@ def read_locations_file(
     Returns:
         Dictionary mapping destination Paths to source Paths or None
 
+    Raises:
+        ValueError: On the first entry that breaks the settings. This happens
+            before anything is installed.
+
     Example TOML content:
         ```toml
         ".bashrc" = "rcfiles/bashrc"
@@ -182,42 +582,49 @@ def read_locations_file(
         ".oldfile" = ""
         ```
     """
+    import tomllib
+
     if fail_if_relative_dst and fail_if_absolute_dst:
         raise ValueError("Can't require both relative and absolute")
-    with Path(toml_file).open("rb") as f:
-        data = tomllib.load(f)
-    locations = {Path(dst): Path(src) if src else None for dst, src in data.items()}
-    # check dst
-    if fail_if_relative_dst and any(not dst.is_absolute() for dst in locations):
-        raise ValueError("settings require all dst must be absolute")
-    if fail_if_absolute_dst and any(dst.is_absolute() for dst in locations):
-        raise ValueError("settings require all dst must be relative")
-    # check src
-    if any(src is not None and src.is_absolute() for src in locations.values()):
-        raise ValueError("all src must be relative")
-    # resolve locations
-    dst_dir = dst_dir.absolute()
-    src_dir = src_dir.absolute()
-    locations_full = {
-        dst_dir / dst.expanduser(): None if src is None else src_dir / src
-        for dst, src in locations.items()
-    }
-    # check parents
-    if not allow_linking_outside_dst_dir and not all(
-        dst_dir in dst.parents for dst in locations_full
-    ):
-        raise ValueError(f"settings require all dst must be inside {dst_dir}")
-    if not all(
-        src is None or src_dir in src.parents for src in locations_full.values()
-    ):
-        # this should never fail, since we checked that all src in locations are
-        #  relative
-        raise ValueError(f"all src must be inside {src_dir}")
-    # result
+    data = tomllib.loads(toml_file.read_bytes().decode())
+    cwd = os.getcwd()
+    dst_dir = Path(cwd, dst_dir)
+    src_dir = Path(cwd, src_dir)
+    # each entry is joined to these shared prefixes by plain concatenation
+    dst_root = os.path.join(dst_dir, "")
+    src_root = os.path.join(src_dir, "")
+    # resolve and check each location in a single pass
+    locations_full: dict[Path, Path | None] = {}
+    for dst, src in data.items():
+        # check dst
+        dst_is_absolute = os.path.isabs(dst)
+        if fail_if_relative_dst and not dst_is_absolute:
+            raise ValueError("settings require all dst must be absolute")
+        if fail_if_absolute_dst and dst_is_absolute:
+            raise ValueError("settings require all dst must be relative")
+        dst_expanded = os.path.expanduser(dst)
+        dst_full = Path(
+            dst_expanded if os.path.isabs(dst_expanded) else dst_root + dst_expanded
+        )
+        if not allow_linking_outside_dst_dir and not _is_inside(dst_full, dst_root):
+            raise ValueError(f"settings require all dst must be inside {dst_dir}")
+        if not src:
+            locations_full[dst_full] = None
+            continue
+        # check src
+        if os.path.isabs(src):
+            raise ValueError("all src must be relative")
+        src_full = Path(src_root + src)
+        if not _is_inside(src_full, src_root):
+            # this should never fail, since we checked that src is relative
+            raise ValueError(f"all src must be inside {src_dir}")
+        locations_full[dst_full] = src_full
     return locations_full
 
 
 def parse_args() -> argparse.Namespace:
+    import argparse
+
     parser = argparse.ArgumentParser(description="install links to a list of files")
     parser.add_argument(
         "SRC_DIR",
@@ -240,6 +647,13 @@ def parse_args() -> argparse.Namespace:
         help="Increase quietness level "
         f"(can be repeated up to {int(MAX_VERBOSE)} times)",
     )
+    parser.add_argument(
+        "-n",
+        "--dry_run",
+        action="store_true",
+        help="Print what would be done, prefixed with [dry run], "
+        "without changing anything",
+    )
     return parser.parse_args()
 
 
@@ -254,13 +668,14 @@ def main() -> None:
         SRC_DIR: Directory containing source files and locations.toml
         -d/--dest_dir: Directory to install links into (default: home directory)
         -q/--quiet: Reduce verbosity (can be specified multiple times)
+        -n/--dry_run: Print what would be done, without changing anything
     """
     args = parse_args()
     src_dir = args.SRC_DIR
     dst_dir = args.dest_dir
     verbose_level = VerboseLevel(MAX_VERBOSE - args.quiet)
     locations = read_locations_file(src_dir / "locations.toml", src_dir, dst_dir)
-    install_links(locations, verbose_level)
+    install_links(locations, verbose_level, dry_run=args.dry_run)
 
 
 if __name__ == "__main__":
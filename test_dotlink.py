@@ -0,0 +1,188 @@
+from pathlib import Path
+
+import pytest
+
+import dotlink
+from dotlink import (
+    Op,
+    OpKind,
+    VerboseLevel,
+    execute,
+    install_links,
+    plan,
+    safe_remove,
+)
+
+
+@pytest.fixture
+def src(tmp_path: Path) -> Path:
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "s1").write_text("s1")
+    (src / "s2").mkdir()
+    return src
+
+
+def test_link_over_dir_created_for_earlier_entry(tmp_path: Path, src: Path) -> None:
+    dst = tmp_path / "dst"
+    locations: dict[Path, Path | None] = {
+        dst / "d/f": src / "s1",
+        dst / "d": src / "s2",
+    }
+    install_links(locations, VerboseLevel.NOTHING)
+    assert (dst / "d").readlink() == src / "s2"
+    assert (dst / "d.bkp_0/f").readlink() == src / "s1"
+
+
+def test_remove_dir_created_for_earlier_entry(tmp_path: Path, src: Path) -> None:
+    dst = tmp_path / "dst"
+    locations: dict[Path, Path | None] = {dst / "d/f": src / "s1", dst / "d": None}
+    install_links(locations, VerboseLevel.NOTHING)
+    assert not (dst / "d").exists(follow_symlinks=False)
+    assert (dst / "d.bkp_0/f").readlink() == src / "s1"
+
+
+def test_rename_keeps_the_unrelated_ensured_dirs(tmp_path: Path, src: Path) -> None:
+    dst = tmp_path / "dst"
+    locations: dict[Path, Path | None] = {
+        dst / "d/f": src / "s1",
+        dst / "e/f": src / "s1",
+        dst / "d": None,
+        dst / "d/g": src / "s1",
+        dst / "e/g": src / "s1",
+    }
+    mkdirs = [op.path for op in plan(locations) if op.kind is OpKind.MKDIR]
+    assert mkdirs == [dst / "d", dst / "e", dst / "d"]
+
+
+@pytest.fixture
+def aliased(tmp_path: Path) -> Path:
+    dst = tmp_path / "dst"
+    (dst / "real").mkdir(parents=True)
+    (dst / "real/f").write_text("old")
+    (dst / "l").symlink_to(dst / "real")
+    return dst
+
+
+def test_backups_through_a_link_get_new_indices(aliased: Path, src: Path) -> None:
+    locations: dict[Path, Path | None] = {
+        aliased / "real/f": src / "s1",
+        aliased / "l/f": src / "s2",
+    }
+    install_links(locations, VerboseLevel.NOTHING)
+    assert (aliased / "real/f.bkp_0").read_text() == "old"
+    assert (aliased / "real/f.bkp_1").readlink() == src / "s1"
+    assert (aliased / "real/f").readlink() == src / "s2"
+
+
+def test_remove_through_a_link_after_removing(aliased: Path) -> None:
+    locations: dict[Path, Path | None] = {
+        aliased / "real/f": None,
+        aliased / "l/f": None,
+    }
+    install_links(locations, VerboseLevel.NOTHING)
+    assert (aliased / "real/f.bkp_0").read_text() == "old"
+    assert sorted(p.name for p in (aliased / "real").iterdir()) == ["f.bkp_0"]
+
+
+def test_rename_does_not_replace_a_backup(tmp_path: Path) -> None:
+    (tmp_path / "f").write_text("new")
+    (tmp_path / "f.bkp_0").write_text("old")
+    op = Op(OpKind.RENAME, tmp_path / "f", tmp_path / "f.bkp_0")
+    with pytest.raises(FileExistsError):
+        execute([op], VerboseLevel.NOTHING)
+    assert (tmp_path / "f").read_text() == "new"
+    assert (tmp_path / "f.bkp_0").read_text() == "old"
+
+
+def test_backup_index_is_one_past_the_highest(tmp_path: Path) -> None:
+    for name in ("f", "f.bkp_0", "f.bkp_2"):
+        (tmp_path / name).touch()
+    # the gap at 1 is not reused, so the new backup sorts last
+    assert safe_remove(tmp_path / "f", VerboseLevel.NOTHING) == tmp_path / "f.bkp_3"
+
+
+def test_backup_index_ignores_non_ascii_digits(tmp_path: Path) -> None:
+    for name in ("f", "f.bkp_1", "f.bkp_\u0661\u0660\u0660", "f.bkp_x"):
+        (tmp_path / name).touch()
+    assert safe_remove(tmp_path / "f", VerboseLevel.NOTHING) == tmp_path / "f.bkp_2"
+
+
+def _snapshot(root: Path) -> list[tuple[str, str]]:
+    return sorted(
+        (
+            str(p.relative_to(root)),
+            str(p.readlink())
+            if p.is_symlink()
+            else "/"
+            if p.is_dir()
+            else p.read_text(),
+        )
+        for p in root.rglob("*")
+    )
+
+
+def test_dry_run_prints_the_real_run_without_changing_anything(
+    tmp_path: Path, src: Path, capsys: pytest.CaptureFixture[str]
+) -> None:
+    dst = tmp_path / "dst"
+    (dst / "d").mkdir(parents=True)
+    (dst / "d/f").write_text("old")
+    (dst / "ok").symlink_to(src / "s1")
+    locations: dict[Path, Path | None] = {
+        dst / "d/f": src / "s1",
+        dst / "ok": src / "s1",
+        dst / "new/g": src / "s2",
+        dst / "d": None,
+    }
+    before = _snapshot(dst)
+    install_links(locations, VerboseLevel.LINK_OK, dry_run=True)
+    dry_lines = capsys.readouterr().out.splitlines()
+    assert _snapshot(dst) == before
+    install_links(locations, VerboseLevel.LINK_OK)
+    lines = capsys.readouterr().out.splitlines()
+    assert lines
+    assert _snapshot(dst) != before
+    assert dry_lines == [f"[dry run] {line}" for line in lines]
+
+
+def test_exists_lines_keep_the_config_order(
+    tmp_path: Path, src: Path, capsys: pytest.CaptureFixture[str]
+) -> None:
+    dst = tmp_path / "dst"
+    dst.mkdir()
+    (dst / "b").symlink_to(src / "s1")
+    locations: dict[Path, Path | None] = {
+        dst / "a": src / "s1",
+        dst / "b": src / "s1",
+        dst / "c": src / "s2",
+    }
+    install_links(locations, VerboseLevel.LINK_OK)
+    assert capsys.readouterr().out.splitlines() == [
+        f"linking  {dst / 'a'} <- {src / 's1'}",
+        f"exists   {dst / 'b'} <- {src / 's1'}",
+        f"linking  {dst / 'c'} <- {src / 's2'}/",
+    ]
+
+
+@pytest.mark.parametrize(
+    ("backups", "expected"),
+    [((), 0), ((0, 1), 2), ((0, 1, 2, 3, 4), 5), ((1,), 0), ((0, 2), 1)],
+)
+def test_backup_index_without_listing(
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    backups: tuple[int, ...],
+    expected: int,
+) -> None:
+    for name in ("f", *(f"f.bkp_{i}" for i in backups)):
+        (tmp_path / name).touch()
+
+    def listdir(path: str) -> list[str]:
+        raise PermissionError(path)
+
+    # searchable but not readable, so only probing finds the backups
+    monkeypatch.setattr(dotlink.os, "listdir", listdir)
+    expected_path = tmp_path / f"f.bkp_{expected}"
+    assert safe_remove(tmp_path / "f", VerboseLevel.NOTHING) == expected_path
+    assert expected_path.read_text() == ""